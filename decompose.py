@@ -1,13 +1,33 @@
 import sqlglot
 from sqlglot import exp
-from graphlib import TopologicalSorter
+from collections import deque
 from graphviz import Digraph
 from dataclasses import dataclass
 from typing import Optional
+import functools
 import re
+import sys
 
+# Separator lines for print_queries, built once
+_SEP_HEAVY = "=" * 70
+_SEP_LIGHT = "-" * 50
 
-@dataclass
+
+@functools.lru_cache(maxsize=128)
+def _parse_one_cached(sql: str, dialect: str) -> exp.Expression:
+    """
+    Cache sqlglot parses by (sql, dialect) — parsing is the heaviest step
+    of decomposition and identical SQL recurs across retries and repeat
+    runs. The cached tree is pristine and must never be handed out
+    directly: materialization detaches and reattaches the WITH clause,
+    so every consumer takes a copy (still far cheaper than re-parsing).
+    """
+    return sqlglot.parse_one(sql, dialect=dialect)
+
+
+
+
+@dataclass(slots=True)
 class DecomposedQuery:
     """A single decomposed query step."""
     name: str
@@ -32,7 +52,9 @@ class SQLDecomposer:
     def __init__(self, sql: str, dialect: str = "snowflake"):
         self.sql = sql
         self.dialect = dialect
-        self._parsed = sqlglot.parse_one(sql, dialect=dialect)
+        # Private copy: concurrent decomposers of the same SQL must not
+        # see each other's temporary WITH-clause detachment
+        self._parsed = _parse_one_cached(sql, dialect).copy()
         self._ctes: dict[str, str] = {}
         self._dependencies: dict[str, list[str]] = {}
         self._queries: list[DecomposedQuery] = []
@@ -40,6 +62,10 @@ class SQLDecomposer:
         self._has_recursive = False  # Flag if any CTE is recursive
         self._skip_decomposition = False  # Flag to skip decomposition entirely
         self._skip_reason = ""  # Reason for skipping
+        self._cte_set: set = set()
+        self._queries_built = False  # Queries are materialized lazily
+        self._by_name: Optional[dict[str, DecomposedQuery]] = None
+        self._graph_cache: Optional[tuple[str, Digraph]] = None  # (title, Digraph)
         self._parse()
     
     def _check_skip_conditions(self) -> bool:
@@ -47,47 +73,36 @@ class SQLDecomposer:
         Check conditions that prevent decomposition entirely.
         Returns True if decomposition should be skipped.
         """
-        # 1. Check for WITH RECURSIVE in original SQL (case-insensitive)
-        if re.search(r'\bWITH\s+RECURSIVE\b', self.sql, re.IGNORECASE):
-            self._skip_reason = "WITH RECURSIVE detected"
-            return True
-        
-        # 2. Check for CTEs inside subqueries (nested WITH clauses)
-        # This happens when we find more than one WITH clause, or WITH inside a subquery
-        with_count = len(re.findall(r'\bWITH\b', self.sql, re.IGNORECASE))
-        if with_count > 1:
-            self._skip_reason = "Nested WITH clauses detected"
-            return True
+        # 1. Check for WITH RECURSIVE on the already-parsed tree — no need to
+        # rescan the SQL text
+        with_nodes = self._parsed.find_all(exp.With)
+        first_with = next(with_nodes, None)
+        if first_with is not None:
+            if first_with.args.get("recursive"):
+                self._skip_reason = "WITH RECURSIVE detected"
+                return True
+
+            # 2. Check for CTEs inside subqueries (nested WITH clauses)
+            # A second exp.With node means a WITH appears inside a subquery
+            second_with = next(with_nodes, None)
+            if second_with is not None:
+                if second_with.args.get("recursive"):
+                    self._skip_reason = "WITH RECURSIVE detected"
+                else:
+                    self._skip_reason = "Nested WITH clauses detected"
+                return True
         
-        # 3. Check if the parsed query has CTEs inside subqueries
+        # 3. Check if the parsed query has CTEs inside subqueries.
+        # Every sqlglot expression carries an args dict, so read the WITH
+        # clause directly instead of probing with hasattr
         for subquery in self._parsed.find_all(exp.Subquery):
             inner = subquery.this
-            if inner and hasattr(inner, 'ctes') and inner.ctes:
+            if inner is not None and inner.args.get("with_", inner.args.get("with")) is not None:
                 self._skip_reason = "CTEs inside subquery"
                 return True
         
         return False
     
-    def _detect_recursive_ctes(self, cte_set: set) -> set[str]:
-        """Detect CTEs that reference themselves (recursive CTEs)."""
-        recursive = set()
-        
-        # Create a lowercase lookup for case-insensitive matching
-        cte_lower = {name.lower(): name for name in cte_set}
-        
-        for cte in (self._parsed.ctes or []):
-            cte_name = cte.alias
-            cte_name_lower = cte_name.lower()
-            
-            # Check if CTE references itself (case-insensitive)
-            for table in cte.this.find_all(exp.Table):
-                table_name_lower = table.name.lower()
-                if table_name_lower == cte_name_lower:
-                    recursive.add(cte_name)
-                    break
-        
-        return recursive
-    
     def _parse(self):
         """Parse SQL and extract CTEs, dependencies, and decomposed queries."""
         # Check if we should skip decomposition entirely
@@ -99,77 +114,144 @@ class SQLDecomposer:
                 sql=self.sql,
                 dependencies=[]
             ))
+            self._queries_built = True
             return
-        
-        # Extract CTEs
+
+        # No CTEs (common case): the original SQL is the single step.
+        # Skips the dependency walks, the topological sort, and the
+        # pretty-printed re-serialization entirely.
+        if not self._parsed.ctes:
+            self._queries.append(DecomposedQuery(
+                name="FINAL_RESULT",
+                sql=self.sql,
+                dependencies=[]
+            ))
+            self._dependencies["__FINAL__"] = []
+            self._queries_built = True
+            return
+
+        # Extract CTEs. Names are interned: they recur as dict keys, set
+        # members and equality operands below, and interned strings compare
+        # by pointer first.
         cte_set = set()
         if self._parsed.ctes:
             for cte in self._parsed.ctes:
-                self._ctes[cte.alias] = cte.this.sql(dialect=self.dialect, pretty=True)
-                cte_set.add(cte.alias)
-        
-        # Detect recursive CTEs BEFORE building dependencies
-        self._recursive_ctes = self._detect_recursive_ctes(cte_set)
-        self._has_recursive = len(self._recursive_ctes) > 0
+                name = sys.intern(cte.alias)
+                self._ctes[name] = cte.this.sql(dialect=self.dialect, pretty=True)
+                cte_set.add(name)
         
-        # Build dependencies (excluding self-references for recursive CTEs)
+        # Build dependencies and detect recursive CTEs in a single walk of
+        # the whole tree. Each Table node is attributed to its enclosing
+        # CTE (or to __FINAL__ when it sits in the main query); a
+        # self-reference (case-insensitive) marks the CTE recursive instead
+        # of becoming a dependency.
         # Use case-insensitive matching for CTE names
-        cte_lower_to_original = {name.lower(): name for name in cte_set}
-        
-        for cte in (self._parsed.ctes or []):
-            cte_name = cte.alias
-            deps = []
-            for table in cte.this.find_all(exp.Table):
-                table_lower = table.name.lower()
-                # Don't add self-reference as dependency
-                if table_lower in cte_lower_to_original and table_lower != cte_name.lower():
-                    deps.append(cte_lower_to_original[table_lower])
-            self._dependencies[cte_name] = list(set(deps))
-        
-        # Final query dependencies
-        main_select = self._parsed.find(exp.Select)
-        if main_select:
-            final_deps = []
-            for t in main_select.find_all(exp.Table):
-                t_lower = t.name.lower()
-                if t_lower in cte_lower_to_original:
-                    final_deps.append(cte_lower_to_original[t_lower])
-            self._dependencies["__FINAL__"] = list(set(final_deps))
-        
-        # Build execution order
-        self._build_queries(cte_set)
+        cte_lower_to_original = {sys.intern(name.lower()): name for name in cte_set}
+        cte_lower_set = cte_lower_to_original.keys()  # dict_keys view, O(1) membership
+        lower = str.lower
+
+        owner_deps: dict[str, set[str]] = {name: set() for name in self._ctes}
+        final_deps: set[str] = set()
+
+        # Flat DFS with (node, owner CTE alias, lowered alias); owner is
+        # inherited by children and switches at exp.CTE boundaries
+        stack: list[tuple[exp.Expression, Optional[str], Optional[str]]] = [
+            (self._parsed, None, None)
+        ]
+        while stack:
+            node, owner, owner_lower = stack.pop()
+            if isinstance(node, exp.CTE):
+                owner = sys.intern(node.alias)
+                owner_lower = lower(owner)
+            elif isinstance(node, exp.Table):
+                table_lower = sys.intern(lower(node.name))
+                if table_lower in cte_lower_set:
+                    if owner is None:
+                        final_deps.add(cte_lower_to_original[table_lower])
+                    elif table_lower == owner_lower:
+                        self._recursive_ctes.add(owner)
+                    else:
+                        owner_deps[owner].add(cte_lower_to_original[table_lower])
+            for value in node.args.values():
+                if isinstance(value, exp.Expression):
+                    stack.append((value, owner, owner_lower))
+                elif isinstance(value, list):
+                    stack.extend(
+                        (item, owner, owner_lower)
+                        for item in value if isinstance(item, exp.Expression)
+                    )
+
+        for name, deps in owner_deps.items():
+            self._dependencies[name] = list(deps)
+        self._dependencies["__FINAL__"] = list(final_deps)
+
+        self._has_recursive = len(self._recursive_ctes) > 0
+        self._cte_set = cte_set
     
-    def _normalize_cte_references(self, sql: str, cte_set: set) -> str:
+    def _cte_reference_pattern(self, cte_set: set) -> Optional[re.Pattern]:
+        """
+        Build a single alternation pattern matching any CTE reference,
+        quoted or unquoted, case-insensitively. Longer names first so a
+        CTE whose name prefixes another is not shadowed.
+        """
+        if not cte_set:
+            return None
+        names = sorted(map(re.escape, cte_set), key=len, reverse=True)
+        return re.compile(r'"?\b(' + '|'.join(names) + r')\b"?', re.IGNORECASE)
+
+    def _normalize_cte_references(self, sql: str, pattern: Optional[re.Pattern]) -> str:
         """
         Replace all CTE references with uppercase unquoted names for consistency.
         This ensures temp table names match how they're created.
         """
-        result = sql
-        
-        for cte_name in cte_set:
-            upper_name = cte_name.upper()
-            lower_name = cte_name.lower()
-            
-            # Replace various quoted forms: "cte_name", "CTE_NAME", "Cte_Name", etc.
-            # Use case-insensitive pattern for quoted identifiers
-            quoted_pattern = rf'"({re.escape(cte_name)})"'
-            result = re.sub(quoted_pattern, upper_name, result, flags=re.IGNORECASE)
-            
-            # Also handle double quotes around exact case
-            result = result.replace(f'"{cte_name}"', upper_name)
-            result = result.replace(f'"{upper_name}"', upper_name)
-            result = result.replace(f'"{lower_name}"', upper_name)
-            
-            # Replace unquoted references with proper case (word boundary aware)
-            # Match the CTE name as a whole word, not inside quotes
-            # Be careful not to match inside strings or already-processed identifiers
-            pattern = rf'(?<!["\w]){re.escape(cte_name)}(?!["\w])'
-            result = re.sub(pattern, upper_name, result, flags=re.IGNORECASE)
-        
-        return result
+        if pattern is None:
+            return sql
+        # One pass over the SQL: uppercase the captured name, dropping any
+        # surrounding quotes consumed by the pattern
+        return pattern.sub(lambda m: m.group(1).upper(), sql)
     
-    def _build_queries(self, cte_set: set):
-        """Build ordered list of executable queries."""
+    @staticmethod
+    def _topological_order(dependencies: dict[str, list[str]], extra_nodes: set) -> list[str]:
+        """
+        Kahn's algorithm over the dependency dict: dependencies execute
+        before their dependents. Works directly on the existing lists
+        instead of rebuilding a dict-of-sets for graphlib.
+        """
+        in_degree: dict[str, int] = {}
+        adjacency: dict[str, list[str]] = {}
+
+        for node, deps in dependencies.items():
+            in_degree[node] = in_degree.get(node, 0) + len(deps)
+            for dep in deps:
+                adjacency.setdefault(dep, []).append(node)
+                in_degree.setdefault(dep, 0)
+        for node in extra_nodes:
+            in_degree.setdefault(node, 0)
+
+        queue = deque(node for node, degree in in_degree.items() if degree == 0)
+        order = []
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for dependent in adjacency.get(node, ()):
+                in_degree[dependent] -= 1
+                if in_degree[dependent] == 0:
+                    queue.append(dependent)
+
+        if len(order) != len(in_degree):
+            raise ValueError("Cycle detected in CTE dependencies")
+        return order
+
+    def _materialize_queries(self):
+        """
+        Build the ordered list of executable queries.
+
+        Deferred until first access so callers that only need the
+        dependency graph or CTE names skip the topological sort, the
+        final-SQL serialization, and the per-CTE normalization passes.
+        """
+        cte_set = self._cte_set
+
         # If there are recursive CTEs, don't decompose - return original SQL as single query
         if self._has_recursive:
             self._queries.append(DecomposedQuery(
@@ -177,28 +259,39 @@ class SQLDecomposer:
                 sql=self.sql,  # Return original SQL unchanged
                 dependencies=[]
             ))
+            self._queries_built = True
             return
-        
+
         # Topological sort
-        graph = {k: set(v) for k, v in self._dependencies.items()}
-        for name in cte_set:
-            if name not in graph:
-                graph[name] = set()
-        
-        exec_order = list(TopologicalSorter(graph).static_order())
+        exec_order = self._topological_order(self._dependencies, cte_set)
         
-        # Get final query SQL and normalize CTE references
-        parsed_copy = self._parsed.copy()
-        with_clause = parsed_copy.find(exp.With)
+        # Get final query SQL and normalize CTE references. Detach the WITH
+        # clause, serialize, and reattach — avoids deep-copying the whole AST.
+        with_clause = self._parsed.find(exp.With)
         if with_clause:
+            parent, arg_key = with_clause.parent, with_clause.arg_key
             with_clause.pop()
-        final_sql = parsed_copy.sql(dialect=self.dialect, pretty=True)
-        final_sql = self._normalize_cte_references(final_sql, cte_set)
-        
+            try:
+                final_sql = self._parsed.sql(dialect=self.dialect, pretty=True)
+            finally:
+                parent.set(arg_key, with_clause)
+        else:
+            final_sql = self._parsed.sql(dialect=self.dialect, pretty=True)
+        cte_pattern = self._cte_reference_pattern(cte_set)
+        final_sql = self._normalize_cte_references(final_sql, cte_pattern)
+
+        # Normalize every CTE body at this single point; the build loop
+        # below then only does string formatting
+        self._ctes = {
+            name: self._normalize_cte_references(body, cte_pattern)
+            for name, body in self._ctes.items()
+        }
+
         # Build query list
+        queries = []
         for name in exec_order:
             if name == "__FINAL__":
-                self._queries.append(DecomposedQuery(
+                queries.append(DecomposedQuery(
                     name="FINAL_RESULT",
                     sql=final_sql,
                     dependencies=self._dependencies.get("__FINAL__", [])
@@ -206,20 +299,29 @@ class SQLDecomposer:
             elif name in self._ctes:
                 # Always use uppercase unquoted table names
                 table_name = name.upper()
-                # Normalize CTE references in the body SQL too
-                body_sql = self._normalize_cte_references(self._ctes[name], cte_set)
-                
-                self._queries.append(DecomposedQuery(
+                queries.append(DecomposedQuery(
                     name=name,
-                    sql=f'CREATE OR REPLACE TEMP TABLE {table_name} AS\n{body_sql}',
+                    sql=f'CREATE OR REPLACE TEMP TABLE {table_name} AS\n{self._ctes[name]}',
                     dependencies=self._dependencies.get(name, [])
                 ))
-    
+        # Only publish on success: instances are cached, and marking built
+        # up front would turn a failed build (e.g. a CTE cycle) into silent
+        # empty results on every later access
+        self._queries = queries
+        self._queries_built = True
+
     @property
     def queries(self) -> list[DecomposedQuery]:
         """List of decomposed queries in execution order."""
+        if not self._queries_built:
+            self._materialize_queries()
         return self._queries
     
+    @property
+    def parsed(self) -> exp.Expression:
+        """The underlying sqlglot AST (treat as read-only)."""
+        return self._parsed
+
     @property
     def dependencies(self) -> dict[str, list[str]]:
         """Dependency graph as dict."""
@@ -252,6 +354,11 @@ class SQLDecomposer:
     
     def graph(self, title: str = "SQL Dependency Graph") -> Digraph:
         """Generate and return a graphviz visualization of the dependency graph."""
+        # The dependency graph is immutable after __init__, so repeat
+        # renders (notebook re-display) reuse the built Digraph
+        if self._graph_cache is not None and self._graph_cache[0] == title:
+            return self._graph_cache[1]
+
         dot = Digraph(comment=title)
         dot.attr(rankdir='TB', size='10,10')
         dot.attr('node', shape='box', style='rounded,filled', fontname='Helvetica')
@@ -266,30 +373,52 @@ class SQLDecomposer:
             
             for dep in deps:
                 dot.edge(dep, node)
-        
+
+        self._graph_cache = (title, dot)
         return dot
     
     def print_queries(self, max_lines: int = 10):
         """Print all decomposed queries."""
-        print("=" * 70)
-        print(f"DECOMPOSED QUERIES ({len(self._queries)} steps)")
-        print("=" * 70)
-        
-        for i, q in enumerate(self._queries, 1):
+        queries = self.queries
+        print(_SEP_HEAVY)
+        print(f"DECOMPOSED QUERIES ({len(queries)} steps)")
+        print(_SEP_HEAVY)
+
+        for i, q in enumerate(queries, 1):
             deps_str = f" ← {q.dependencies}" if q.dependencies else ""
             print(f"\n-- [{i}] {q.name}{deps_str}")
-            print("-" * 50)
-            lines = q.sql.split('\n')
-            print('\n'.join(lines[:max_lines]))
-            if len(lines) > max_lines:
-                print(f"    ... ({len(lines) - max_lines} more lines)")
+            print(_SEP_LIGHT)
+            # Find the end of the max_lines-th line without splitting the
+            # whole SQL into a list
+            end = -1
+            for _ in range(max_lines):
+                end = q.sql.find('\n', end + 1)
+                if end == -1:
+                    break
+            if end == -1:
+                print(q.sql)
+            else:
+                print(q.sql[:end])
+                remaining = q.sql.count('\n', end)
+                print(f"    ... ({remaining} more lines)")
     
     def get_query(self, name: str) -> Optional[DecomposedQuery]:
         """Get a specific query by name."""
-        for q in self._queries:
-            if q.name == name:
-                return q
-        return None
+        if self._by_name is None:
+            self._by_name = {q.name: q for q in self.queries}
+        return self._by_name.get(name)
     
     def __repr__(self):
-        return f"SQLDecomposer(ctes={self.cte_names}, queries={len(self._queries)})"
+        return f"SQLDecomposer(ctes={self.cte_names}, queries={len(self.queries)})"
+
+
+@functools.lru_cache(maxsize=256)
+def get_decomposer(sql: str, dialect: str = "snowflake") -> SQLDecomposer:
+    """
+    Memoized SQLDecomposer factory.
+
+    Repeated decomposition of the same SQL (notebook re-runs, pipeline
+    retries) skips the sqlglot parse and AST walks entirely. The returned
+    instance is shared across callers and must be treated as read-only.
+    """
+    return SQLDecomposer(sql, dialect=dialect)
@@ -1,7 +1,15 @@
+import atexit
+import functools
+from collections import Counter
 import os
 import json
 import math
+import re
+import queue
+import threading
+import numpy as np
 import pandas as pd
+from contextlib import contextmanager
 from typing import Dict, Any, Optional, List, Tuple
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
@@ -10,16 +18,23 @@ import snowflake.connector
 import sqlglot
 from sqlglot import exp
 
+try:
+    import orjson  # C-level JSON; several times faster on large result files
+except ImportError:
+    orjson = None
+
 from decompose import SQLDecomposer
 
 
+@functools.lru_cache(maxsize=1)
 def get_snowflake_credentials():
-    """Load Snowflake credentials from environment variables."""
+    """Load Snowflake credentials from environment variables (cached:
+    env vars are stable for the process lifetime)."""
     required = ["SNOWFLAKE_USER", "SNOWFLAKE_PASSWORD", "SNOWFLAKE_ACCOUNT"]
     missing = [var for var in required if not os.environ.get(var)]
     if missing:
         raise ValueError(f"Missing required environment variables: {', '.join(missing)}")
-    
+
     return {
         "user": os.environ.get("SNOWFLAKE_USER"),
         "password": os.environ.get("SNOWFLAKE_PASSWORD"),
@@ -29,6 +44,87 @@ def get_snowflake_credentials():
     }
 
 
+# Matches the temp-table DDL emitted by the decomposer, capturing the name
+_TEMP_TABLE_RE = re.compile(
+    r'^\s*CREATE\s+OR\s+REPLACE\s+TEMP(?:ORARY)?\s+TABLE\s+("?[\w$]+"?)',
+    re.IGNORECASE,
+)
+
+# Connection pools keyed by (database, schema). The TLS + auth handshake
+# dominates wall-clock for short queries under the thread pool, so
+# connections are reused instead of opened per query.
+_connection_pools: Dict[tuple, queue.Queue] = {}
+_pools_lock = threading.Lock()
+
+
+def _pool_for(key: tuple) -> queue.Queue:
+    with _pools_lock:
+        pool = _connection_pools.get(key)
+        if pool is None:
+            pool = _connection_pools[key] = queue.Queue()
+        return pool
+
+
+def _build_conn_kwargs(timeout: int) -> Dict[str, Any]:
+    """Connection kwargs from the cached credentials, varying only the
+    statement timeout."""
+    return {**get_snowflake_credentials(),
+            "session_parameters": {"STATEMENT_TIMEOUT_IN_SECONDS": timeout}}
+
+
+@contextmanager
+def borrow_conn(database: str, schema: Optional[str] = None, timeout: int = 120):
+    """
+    Borrow a pooled Snowflake connection for (database, schema), opening a
+    new one when the pool is empty. The statement timeout is adjusted via
+    ALTER SESSION only when it differs from the connection's current value.
+    Connections are returned to the pool on exit and closed at interpreter
+    shutdown.
+    """
+    pool = _pool_for((database, schema))
+    conn = None
+    while conn is None:
+        try:
+            candidate = pool.get_nowait()
+        except queue.Empty:
+            break
+        if not candidate.is_closed():
+            conn = candidate
+
+    if conn is None:
+        connection_kwargs = _build_conn_kwargs(timeout)
+        if schema:
+            connection_kwargs["schema"] = schema
+        conn = snowflake.connector.connect(database=database, **connection_kwargs)
+        conn._statement_timeout = timeout
+    elif getattr(conn, "_statement_timeout", None) != timeout:
+        with conn.cursor() as cursor:
+            cursor.execute(f"ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = {timeout}")
+        conn._statement_timeout = timeout
+
+    try:
+        yield conn
+    finally:
+        if not conn.is_closed():
+            pool.put(conn)
+
+
+def _close_pooled_connections():
+    for pool in _connection_pools.values():
+        while True:
+            try:
+                conn = pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+atexit.register(_close_pooled_connections)
+
+
 
 def compare_pandas_table(pred, gold, condition_cols=[], ignore_order=False):
     """_summary_
@@ -60,24 +156,63 @@ def compare_pandas_table(pred, gold, condition_cols=[], ignore_order=False):
                 return False
         return True
     
+    def columns_match(a, b, ignore_order_=False):
+        """Column-level comparison: vectorized for numeric dtypes, falling
+        back to the per-cell vectors_match for object/mixed columns."""
+        if len(a) != len(b):
+            return False
+        if a.dtype.kind in "iuf" and b.dtype.kind in "iuf":
+            x = a.astype(float, copy=False)
+            y = b.astype(float, copy=False)
+            if ignore_order_:
+                x, y = np.sort(x), np.sort(y)
+            return bool(np.isclose(x, y, rtol=1e-9, atol=tolerance, equal_nan=True).all())
+        return vectors_match(a.tolist(), b.tolist(), ignore_order_=ignore_order_)
+
     if condition_cols != []:
         gold_cols = gold.iloc[:, condition_cols]
     else:
         gold_cols = gold
     pred_cols = pred
-    
-    t_gold_list = gold_cols.transpose().values.tolist()
-    t_pred_list = pred_cols.transpose().values.tolist()
-    score = 1
+
+    def column_fingerprint(arr):
+        """Cheap per-column summary used to reject non-matches before the
+        full comparison. Only tolerance-safe features are used: length
+        always, plus NaN count, sum, and sum of magnitudes for numeric
+        columns. Object columns may still match numeric ones within
+        tolerance, so they carry no numeric features."""
+        if arr.dtype.kind in "iuf":
+            x = arr.astype(float, copy=False)
+            return (arr.size, int(np.isnan(x).sum()), float(np.nansum(x)),
+                    float(np.nansum(np.abs(x))))
+        return (arr.size, None, None, None)
+
+    def may_match(gold_fp, pred_fp):
+        if gold_fp[0] != pred_fp[0]:
+            return False
+        if gold_fp[1] is not None and pred_fp[1] is not None:
+            if gold_fp[1] != pred_fp[1]:
+                return False
+            # Per-element tolerance bounds the achievable sum difference:
+            # atol per element plus the relative slack the comparison
+            # grants, which scales with magnitudes (not the signed sum —
+            # mixed-sign columns cancel)
+            bound = gold_fp[0] * tolerance + 1e-9 * (gold_fp[3] + pred_fp[3]) + 1e-6
+            if abs(gold_fp[2] - pred_fp[2]) > bound:
+                return False
+        return True
+
+    t_gold_list = [gold_cols.iloc[:, i].to_numpy() for i in range(gold_cols.shape[1])]
+    t_pred_list = [pred_cols.iloc[:, j].to_numpy() for j in range(pred_cols.shape[1])]
+    pred_fingerprints = [column_fingerprint(arr) for arr in t_pred_list]
     for _, gold in enumerate(t_gold_list):
-        if not any(vectors_match(gold, pred, ignore_order_=ignore_order) for pred in t_pred_list):
-            score = 0
-        else:
-            for j, pred in enumerate(t_pred_list):
-                if vectors_match(gold, pred, ignore_order_=ignore_order):
-                    break
+        gold_fp = column_fingerprint(gold)
+        candidates = [j for j, pred_fp in enumerate(pred_fingerprints) if may_match(gold_fp, pred_fp)]
+        if not any(columns_match(gold, t_pred_list[j], ignore_order_=ignore_order) for j in candidates):
+            # One unmatched gold column is unrecoverable
+            return 0
 
-    return score
+    return 1
 
 
 def execute_sql_to_dataframe(sql_query: str, database: str, timeout: int,  instance_id: str = None) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
@@ -85,32 +220,22 @@ def execute_sql_to_dataframe(sql_query: str, database: str, timeout: int,  insta
     Execute SQL and return DataFrame or error message.
     Uses the evaluation suite's connection approach.
     """
-    credentials = get_snowflake_credentials()
-    connection_kwargs = {k: v for k, v in credentials.items() if k != "session_parameters"}
-    session_parameters = credentials.get("session_parameters", {}).copy()
-    session_parameters["STATEMENT_TIMEOUT_IN_SECONDS"] = timeout
-    connection_kwargs["session_parameters"] = session_parameters
-    
-    conn = None
     prefix = f"[{instance_id}] " if instance_id else ""
-    
+
     try:
-        conn = snowflake.connector.connect(
-            database=database,
-            **connection_kwargs
-        )
-        cursor = conn.cursor()
-        cursor.execute(sql_query)
-        
-        results = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(results, columns=columns)
-        
+        with borrow_conn(database, timeout=timeout) as conn:
+            cursor = conn.cursor()
+            cursor.execute(sql_query)
+
+            # Arrow result path: streams columnar batches straight into the
+            # DataFrame, skipping the Python row-tuple round-trip
+            df = cursor.fetch_pandas_all()
+
         if df.empty:
             return None, "No data returned"
-        
+
         return df, None
-        
+
     except snowflake.connector.errors.ProgrammingError as e:
         error_message = str(e)
         if "STATEMENT_TIMEOUT" in error_message or "SQL execution canceled" in error_message:
@@ -118,9 +243,6 @@ def execute_sql_to_dataframe(sql_query: str, database: str, timeout: int,  insta
         return None, f"SQL Error: {error_message}"
     except Exception as e:
         return None, f"Error: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
 
 
 def execute_batch_sql_to_dataframe(queries: List[str],database: str, schema: Optional[str], timeout: int, instance_id: str = None) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
@@ -128,39 +250,41 @@ def execute_batch_sql_to_dataframe(queries: List[str],database: str, schema: Opt
     Execute multiple SQL queries in a single connection (for temp tables).
     Returns the result of the final query.
     """
-    credentials = get_snowflake_credentials()
-    connection_kwargs = {k: v for k, v in credentials.items() if k != "session_parameters"}
-    session_parameters = credentials.get("session_parameters", {}).copy()
-    session_parameters["STATEMENT_TIMEOUT_IN_SECONDS"] = timeout
-    connection_kwargs["session_parameters"] = session_parameters
-    
-    conn = None
     prefix = f"[{instance_id}] " if instance_id else ""
-    
+
     try:
-        # Set database and schema for temp table creation
-        conn = snowflake.connector.connect(
-            database=database,
-            schema=schema if schema else database,  # Default schema to database name
-            **connection_kwargs
-        )
-        cursor = conn.cursor()
-        
-        # Execute all queries, return result from last one
-        final_df = None
-        for i, sql in enumerate(queries):
-            cursor.execute(sql)
-            
-            if cursor.description:
-                results = cursor.fetchall()
-                columns = [desc[0] for desc in cursor.description]
-                final_df = pd.DataFrame(results, columns=columns)
-        
+        # Schema defaults to the database name for temp table creation
+        with borrow_conn(database, schema=schema if schema else database, timeout=timeout) as conn:
+            final_df = None
+            try:
+                # Send the whole batch in one request instead of one
+                # round-trip per statement; only the last statement's result
+                # is returned, so intermediate temp-table DDL is never fetched
+                cursors = conn.execute_string(";\n".join(queries))
+                last_cursor = cursors[-1]
+                if last_cursor.description:
+                    final_df = last_cursor.fetch_pandas_all()
+            finally:
+                # Temp tables shadow same-named permanent tables for the
+                # rest of the session — even schema-qualified references —
+                # so the next borrower of this pooled connection could
+                # silently read this query's intermediate results. Drop
+                # them before the connection goes back to the pool.
+                if not conn.is_closed():
+                    temp_tables = [m.group(1) for m in map(_TEMP_TABLE_RE.match, queries) if m]
+                    if temp_tables:
+                        with conn.cursor() as cleanup:
+                            for name in temp_tables:
+                                try:
+                                    cleanup.execute(f"DROP TABLE IF EXISTS {name}")
+                                except Exception:
+                                    pass
+
         if final_df is None or final_df.empty:
             return None, "No data returned"
-        
+
         return final_df, None
-        
+
     except snowflake.connector.errors.ProgrammingError as e:
         error_message = str(e)
         if "STATEMENT_TIMEOUT" in error_message or "SQL execution canceled" in error_message:
@@ -168,19 +292,14 @@ def execute_batch_sql_to_dataframe(queries: List[str],database: str, schema: Opt
         return None, f"SQL Error: {error_message}"
     except Exception as e:
         return None, f"Error: {str(e)}"
-    finally:
-        if conn:
-            conn.close()
 
 
-def extract_schema_from_sql(sql: str, database: str, dialect: str = "snowflake") -> Optional[str]:
+def extract_schema_from_ast(parsed: exp.Expression, database: str) -> Optional[str]:
     """
-    Extract the schema from fully qualified table references in SQL.
-    Table references like DATABASE.SCHEMA.TABLE.
+    Extract the schema from fully qualified table references in an
+    already-parsed AST. Table references like DATABASE.SCHEMA.TABLE.
     """
     try:
-        parsed = sqlglot.parse_one(sql, dialect=dialect)
-        
         for table in parsed.find_all(exp.Table):
             table_db = table.db  # Schema in Snowflake's 3-part naming
             table_catalog = table.catalog  # Database
@@ -196,38 +315,65 @@ def extract_schema_from_sql(sql: str, database: str, dialect: str = "snowflake")
         return None
 
 
+@functools.lru_cache(maxsize=4096)
+def extract_schema_from_sql(sql: str, database: str, dialect: str = "snowflake") -> Optional[str]:
+    """
+    Extract the schema from fully qualified table references in SQL.
+    Parses with sqlglot; prefer extract_schema_from_ast when an AST is
+    already available. Cached, since datasets repeat SQL templates.
+    """
+    try:
+        parsed = sqlglot.parse_one(sql, dialect=dialect)
+    except Exception:
+        return None
+    return extract_schema_from_ast(parsed, database)
+
+
+@functools.lru_cache(maxsize=4096)
+def _decompose_queries(sql: str, dialect: str = "snowflake") -> Tuple[Tuple[str, ...], exp.Expression]:
+    """
+    Decompose SQL into its step statements, cached by (sql, dialect).
+    Returns (steps, parsed AST) from the one decomposer it builds, so
+    schema extraction reuses the parse instead of running sqlglot again.
+    The steps tuple is immutable and the AST is the decomposer's private
+    copy, only read after construction, so cache hits are safe to share
+    across worker threads.
+    """
+    decomposer = SQLDecomposer(sql, dialect=dialect)
+    return tuple(q.sql for q in decomposer.queries), decomposer.parsed
+
+
 def execute_decomposed_sql(sql: str, database: str, timeout: int, instance_id: str = None) -> Tuple[Optional[pd.DataFrame], Optional[str]]:
     """
     Decompose SQL and execute each step.
     """
     try:
-        decomposer = SQLDecomposer(sql, dialect="snowflake")
-        queries = decomposer.queries
-        
+        queries, parsed = _decompose_queries(sql)
+
         if not queries:
             return None, "No queries to execute"
-        
+
         # If only one query (no decomposition needed), execute directly
         if len(queries) == 1:
             return execute_sql_to_dataframe(
-                queries[0].sql, 
-                database, 
+                queries[0],
+                database,
                 timeout=timeout,
                 instance_id=instance_id
             )
-        
-        # Extract schema for temp table creation
-        schema = extract_schema_from_sql(sql, database)
-        
-        sql_statements = [q.sql for q in queries]
+
+        # Extract schema for temp table creation from the decomposer's
+        # AST — no second parse, cached or not
+        schema = extract_schema_from_ast(parsed, database)
+
         return execute_batch_sql_to_dataframe(
-            sql_statements,
+            list(queries),
             database,
             schema=schema,
             timeout=timeout,
             instance_id=instance_id
         )
-        
+
     except Exception as e:
         return None, f"Decomposition error: {str(e)}"
 
@@ -242,7 +388,18 @@ def compare_dataframes(df1: pd.DataFrame, df2: pd.DataFrame) -> Tuple[bool, str]
     
     if df1 is None or df2 is None:
         return False, "one_empty"
-    
+
+    # Fast path: when the frames are already aligned, DataFrame.equals is
+    # a single C-level comparison. Falls through to the tolerant
+    # (order/column-permutation-insensitive) path on any mismatch.
+    try:
+        if (df1.shape == df2.shape
+                and (df1.dtypes.values == df2.dtypes.values).all()
+                and df1.reset_index(drop=True).equals(df2.reset_index(drop=True))):
+            return True, "match"
+    except Exception:
+        pass
+
     # Use evaluation suite's comparison (tolerant to order and small numeric differences)
     try:
         score = compare_pandas_table(df1, df2, condition_cols=[], ignore_order=True)
@@ -309,43 +466,41 @@ def run_parallel(sql_data: List[Dict], max_workers: int, timeout: int) -> List[D
     results = []
     
     with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_query = {
-            executor.submit(process_single_query, query, timeout): query 
-            for query in sql_data
-        }
-        
-        with tqdm(total=len(sql_data), desc="Processing queries") as pbar:
-            for future in as_completed(future_to_query):
-                result = future.result()
-                results.append(result)
-                pbar.update(1)
-                
-                status = "✓" if result["match"] else "✗"
-                pbar.set_postfix_str(f"{result['instance_id']}: {status}")
-    
+        # A plain list is enough: each result dict carries its own
+        # instance_id, so the future -> query mapping was never read
+        futures = [executor.submit(process_single_query, query, timeout)
+                   for query in sql_data]
+
+        # mininterval throttles terminal redraws; per-future postfix updates
+        # forced a redraw on every completion
+        for future in tqdm(as_completed(futures), total=len(sql_data),
+                           desc="Processing queries", mininterval=0.5, smoothing=0):
+            results.append(future.result())
+
     return results
 
 
 def print_summary(results: List[Dict]):
     """Print summary of results."""
     total = len(results)
-    matches = sum(1 for r in results if r["match"])
-    
+
+    # Single pass: match count and per-reason breakdown together
+    matches = 0
+    reasons = Counter()
+    for r in results:
+        if r["match"]:
+            matches += 1
+        reasons[r["reason"]] += 1
+
     print("\n" + "=" * 70)
     print("SUMMARY")
     print("=" * 70)
     print(f"Total queries: {total}")
     print(f"Matches:       {matches} ({100*matches/total:.1f}%)")
     print(f"Mismatches:    {total - matches} ({100*(total-matches)/total:.1f}%)")
-    
-    # Group by reason
-    reasons = {}
-    for r in results:
-        reason = r["reason"]
-        reasons[reason] = reasons.get(reason, 0) + 1
-    
+
     print("\nBreakdown by reason:")
-    for reason, count in sorted(reasons.items(), key=lambda x: -x[1]):
+    for reason, count in reasons.most_common():
         print(f"  {reason}: {count}")
     
     # Show first few failures
@@ -372,8 +527,9 @@ def main():
     
     # Load SQL data
     print(f"Loading SQL data from {args.data}...")
-    with open(args.data, "r") as f:
-        sql_data = json.load(f)
+    with open(args.data, "rb") as f:
+        raw = f.read()
+    sql_data = orjson.loads(raw) if orjson is not None else json.loads(raw)
     
     print(f"Loaded {len(sql_data)} queries")
     print(f"Using {args.workers} parallel workers")
@@ -387,8 +543,11 @@ def main():
     
     # Save detailed results if requested
     if args.output:
-        with open(args.output, "w") as f:
-            json.dump(results, f, indent=2)
+        with open(args.output, "wb") as f:
+            if orjson is not None:
+                f.write(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+            else:
+                f.write(json.dumps(results, indent=2).encode("utf-8"))
         print(f"\nDetailed results saved to {args.output}")
 
 
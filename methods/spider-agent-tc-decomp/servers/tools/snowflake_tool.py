@@ -1,27 +1,78 @@
 import snowflake.connector
 from snowflake.connector.errors import ProgrammingError, DatabaseError
-import pandas as pd
+from functools import lru_cache
 from typing import Dict, Any, Optional
+import csv
+import hashlib
+import io
 import logging
+import re
 import time
 import os
 
 logger = logging.getLogger(__name__)
 
 from dotenv import load_dotenv
-if os.path.exists("../../snowflake.key"):
-    load_dotenv("../../snowflake.key")
+# Only touch the key file when the environment is not already populated:
+# this module is re-imported per worker process under orchestration, and
+# pure-env configuration should not require the file to exist at all.
+if not os.environ.get("SNOWFLAKE_USER"):
+    if os.path.exists("../../snowflake.key"):
+        load_dotenv("../../snowflake.key")
+    else:
+        raise FileNotFoundError("snowflake.key not found")
 else:
-    raise FileNotFoundError("snowflake.key not found")
+    logger.debug("Snowflake credentials already in environment; skipping snowflake.key")
 
 TIMEOUT = 300  # 5 minutes for complex queries
 MAX_CSV_CHARS = 2000
 
-# Session connection pool
+# Prebuilt fragments for result formatting; a single join beats a
+# multi-line f-string's chain of intermediate allocations on the hot path
+_OK_HEADER = "Query executed successfully\n\n```csv\n"
+_OK_FOOTER = "\n```"
+_TRUNC_NOTE = (
+    "\n\nNote: The result has been truncated to {max_chars} characters for "
+    "display purposes. The complete result set contains {rows} rows."
+)
+
+# Matches a leading SELECT without uppercasing the whole statement
+_SELECT_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+
+# Session connection pool: session_id -> (connection, current database)
 _session_connections = {}
 
+# Materialized steps: (session_id, connection generation, sha1 of the
+# wrapped DDL) -> (step_name, wrapped DDL). The agent re-runs identical
+# prefix steps while iterating; a hit means the temp table already holds
+# this exact result, so re-executing it server-side would be pure
+# recompute. The generation ties entries to one physical connection —
+# temp tables die when a dead connection is replaced, so stale entries
+# must never answer "already materialized".
+_step_cache: Dict[tuple, tuple] = {}
+_session_generations: Dict[str, int] = {}
+
+def _forget_session_steps(session_id: str):
+    """Drop all cached steps for a session (its temp tables are gone)."""
+    for key in [k for k in _step_cache if k[0] == session_id]:
+        del _step_cache[key]
+
+def _forget_dependent_steps(session_id: str, step_name: str):
+    """Drop cached steps whose SQL reads a step that is being redefined:
+    their temp tables still exist but hold results computed from the old
+    definition."""
+    pattern = re.compile(r'\b' + re.escape(step_name) + r'\b', re.IGNORECASE)
+    for key in [k for k, (name, sql) in _step_cache.items()
+                if k[0] == session_id and (name == step_name or pattern.search(sql))]:
+        del _step_cache[key]
+
+@lru_cache(maxsize=1)
 def get_snowflake_credentials() -> Dict[str, str]:
-    """Load Snowflake credentials from environment variables."""
+    """Load Snowflake credentials from environment variables.
+
+    Env vars are stable for the process lifetime, so the dict is built
+    once and reused; callers that mutate it must copy first.
+    """
     return {
         "user": os.environ.get("SNOWFLAKE_USER"),
         "password": os.environ.get("SNOWFLAKE_PASSWORD"),
@@ -34,40 +85,54 @@ def close_session(session_id: str = "default"):
     """Close session connection."""
     if session_id in _session_connections:
         try:
-            _session_connections[session_id].close()
+            _session_connections[session_id][0].close()
         except:
             pass
         del _session_connections[session_id]
+    # Temp tables die with the session; forget its materialized steps
+    _forget_session_steps(session_id)
 
 def _format_sql_result(cursor: Any) -> str:
-    """Helper to format SQL execution results."""
+    """
+    Helper to format SQL execution results.
+
+    Rows are streamed in chunks and CSV serialization stops once the
+    display budget (MAX_CSV_CHARS) is filled; the remaining rows are only
+    counted, never materialized. Large result sets therefore cost
+    O(MAX_CSV_CHARS) memory instead of a full DataFrame copy.
+    """
     if cursor.description:
         headers = [desc[0] for desc in cursor.description]
-        rows = cursor.fetchall()
-        if rows:
-            df = pd.DataFrame(rows, columns=headers)
-            full_csv_data = df.to_csv(index=False)
-            total_rows = len(df)
-            
-            if len(full_csv_data) > MAX_CSV_CHARS:
-                truncated_csv = full_csv_data[:MAX_CSV_CHARS]
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(headers)
+
+        total_rows = 0
+        serialized = True
+        while True:
+            rows = cursor.fetchmany(1024)
+            if not rows:
+                break
+            total_rows += len(rows)
+            if serialized:
+                writer.writerows(rows)
+                if buf.tell() > MAX_CSV_CHARS:
+                    serialized = False  # budget filled; keep counting only
+
+        if total_rows:
+            if buf.tell() > MAX_CSV_CHARS:
+                # Copy out only the displayed prefix; getvalue() followed
+                # by a slice would duplicate the whole buffer first
+                buf.seek(0)
+                truncated_csv = buf.read(MAX_CSV_CHARS)
                 last_newline = truncated_csv.rfind('\n')
                 if last_newline > 0:
                     truncated_csv = truncated_csv[:last_newline]
-                
-                return f"""Query executed successfully
 
-```csv
-{truncated_csv}
-```
-
-Note: The result has been truncated to {MAX_CSV_CHARS} characters for display purposes. The complete result set contains {total_rows} rows and {len(full_csv_data)} characters."""
+                return ''.join((_OK_HEADER, truncated_csv, _OK_FOOTER,
+                                _TRUNC_NOTE.format(max_chars=MAX_CSV_CHARS, rows=total_rows)))
             else:
-                return f"""Query executed successfully
-
-```csv
-{full_csv_data}
-```"""
+                return ''.join((_OK_HEADER, buf.getvalue(), _OK_FOOTER))
         else:
             return "Query executed successfully, but no rows returned."
     else:
@@ -76,22 +141,29 @@ Note: The result has been truncated to {MAX_CSV_CHARS} characters for display pu
 def get_or_create_connection(session_id: str, database: str = None) -> Any:
     """Get existing connection or create new one for session."""
     if session_id in _session_connections:
-        conn = _session_connections[session_id]
+        conn, current_database = _session_connections[session_id]
         if not conn.is_closed():
-            if database:
+            # Only pay the USE DATABASE round-trip when the session is
+            # actually switching databases
+            if database and database != current_database:
                 try:
                     with conn.cursor() as cursor:
                         cursor.execute(f"USE DATABASE {database}")
+                    _session_connections[session_id] = (conn, database)
                 except Exception as e:
                     logger.warning(f"Could not switch database to {database} for existing session {session_id}: {str(e)}")
             return conn
 
-    creds = get_snowflake_credentials()
+    creds = dict(get_snowflake_credentials())
     if database:
         creds['database'] = database
-    
+
     conn = snowflake.connector.connect(**creds)
-    _session_connections[session_id] = conn
+    _session_connections[session_id] = (conn, database)
+    # New physical connection: any previously materialized temp tables
+    # are gone, so retire the old generation's cached steps
+    _session_generations[session_id] = _session_generations.get(session_id, 0) + 1
+    _forget_session_steps(session_id)
     return conn
 
 def _execute_query(sql: str, session_id: str, database: str = None) -> str:
@@ -119,19 +191,63 @@ def execute_snowflake_sql(sql: str = None, session_id: str = "default", **kwargs
     
     return {"content": f"EXECUTION RESULT of [execute_snowflake_sql]:\n{content}"}
 
+def _materialize_step(sql: str, step_name: str, session_id: str, database: str = None) -> str:
+    """
+    Run a step-materialization DDL without pulling back its result.
+
+    CREATE ... TEMP TABLE only returns a one-row status frame that the
+    agent discards; submit with _no_results to skip the result buffering,
+    wait for completion so errors still surface and dependent steps
+    cannot race ahead, and return a canned notice.
+    """
+    try:
+        conn = get_or_create_connection(session_id, database)
+        with conn.cursor() as cursor:
+            cursor.execute(sql, _no_results=True)
+            sfqid = cursor.sfqid
+            while conn.is_still_running(conn.get_query_status_throw_if_error(sfqid)):
+                time.sleep(0.1)
+        return f"Step {step_name} materialized."
+    except (ProgrammingError, DatabaseError) as e:
+        logger.error(f"Snowflake SQL error (session: {session_id}): {str(e)}")
+        return f"SQL Error: {str(e)}"
+    except Exception as e:
+        logger.error(f"Unexpected error (session: {session_id}): {str(e)}")
+        return f"Unexpected error: {str(e)}"
+
 def execute_sql_step(sql: str = None, step_name: Optional[str] = None, session_id: str = "default", **kwargs) -> Dict[str, Any]:
     """Execute a sub-SQL as part of iterative decomposition."""
     if not sql:
         return {"content": "ERROR: 'sql' is a required parameter."}
-    
-    # Auto-wrap SELECT as temp table creation if step_name provided
-    if step_name and sql.strip().upper().startswith("SELECT"):
-        sql = f"CREATE OR REPLACE TEMP TABLE {step_name} AS\n{sql}"
-    
+
     logger.info(f"Executing SQL step (session: {session_id}, step: {step_name})")
     database = kwargs.get('database')
-    content = _execute_query(sql, session_id, database)
-    
+
+    # Auto-wrap SELECT as temp table creation if step_name provided
+    if step_name and _SELECT_RE.match(sql):
+        sql = f"CREATE OR REPLACE TEMP TABLE {step_name} AS\n{sql.lstrip()}"
+        # Ensure the session connection is alive before consulting the
+        # cache: replacing a dead connection bumps the generation, which
+        # retires entries whose temp tables died with it
+        try:
+            get_or_create_connection(session_id, database)
+        except Exception:
+            pass  # _materialize_step surfaces the connection error
+        generation = _session_generations.get(session_id, 0)
+        cache_key = (session_id, generation,
+                     hashlib.sha1(sql.encode('utf-8')).hexdigest())
+        if cache_key in _step_cache:
+            content = f"Step {step_name} already materialized in this session; reusing temp table."
+        else:
+            content = _materialize_step(sql, step_name, session_id, database)
+            if content == f"Step {step_name} materialized.":
+                # Steps built on the previous definition of this table
+                # are stale now; they must re-materialize on next use
+                _forget_dependent_steps(session_id, step_name)
+                _step_cache[cache_key] = (step_name, sql)
+    else:
+        content = _execute_query(sql, session_id, database)
+
     return {"content": f"EXECUTION RESULT of [execute_sql_step]:\n{content}"}
 
 def register_tools(registry):
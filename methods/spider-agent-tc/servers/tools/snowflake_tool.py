@@ -1,8 +1,12 @@
 import snowflake.connector
 from snowflake.connector.errors import ProgrammingError, DatabaseError
-import pandas as pd
+from functools import lru_cache
 from typing import Dict, Any
+import csv
+import io
 import logging
+import re
+import threading
 import time
 import os
 
@@ -11,8 +15,76 @@ logger = logging.getLogger(__name__)
 TIMEOUT = 300  # 5 minutes for complex queries
 MAX_CSV_CHARS = 2000
 
+# Prebuilt fragments for result formatting; a single join beats a
+# multi-line f-string's chain of intermediate allocations on the hot path
+_OK_HEADER = "Query executed successfully\n\n```csv\n"
+_OK_FOOTER = "\n```"
+_TRUNC_NOTE = (
+    "\n\nNote: The result has been truncated to {max_chars} characters for "
+    "display purposes. The complete result set contains {rows} rows."
+)
+# For LIMIT-rewritten queries the cursor only ever sees the preview, so
+# quoting its rowcount as "the complete result set" would be false
+_TRUNC_NOTE_PREVIEW = (
+    "\n\nNote: The result has been truncated to {max_chars} characters for "
+    "display purposes. The query was limited to a preview of {rows} rows; "
+    "the full result set may contain more."
+)
+_PREVIEW_NOTE = (
+    "\n\nNote: The query was limited to a preview of {rows} rows; the full "
+    "result set may contain more."
+)
+
+# Display output is capped at MAX_CSV_CHARS, so exploratory SELECTs are
+# wrapped in an outer LIMIT to avoid shipping rows that can never be shown
+PREVIEW_ROWS = 200
+_SELECT_RE = re.compile(r'^\s*SELECT\b', re.IGNORECASE)
+_NO_LIMIT_REWRITE_RE = re.compile(r'\b(LIMIT|INTO|GROUP BY|ORDER BY)\b', re.IGNORECASE)
+
+# Session connection pool: session_id -> (connection, current database)
+_session_connections = {}
+
+# Heartbeat timers keeping pooled sessions' warehouses from auto-suspending
+_session_heartbeats = {}
+HEARTBEAT_INTERVAL = 240  # seconds; under typical warehouse auto-suspend
+
+def _schedule_heartbeat(session_id: str):
+    """Ping the session every few minutes so its warehouse stays warm.
+
+    Warehouses auto-suspend after idle and the next query then pays a
+    multi-second resume; a trivial SELECT resets the idle clock. The
+    timer reschedules itself and dies with the connection.
+    """
+    # A reconnect schedules anew while the old chain's timer is still
+    # pending; cancel it so each session runs exactly one chain
+    pending = _session_heartbeats.get(session_id)
+    if pending is not None:
+        pending.cancel()
+
+    def _beat():
+        entry = _session_connections.get(session_id)
+        if entry is None or entry[0].is_closed():
+            _session_heartbeats.pop(session_id, None)
+            return
+        try:
+            with entry[0].cursor() as cursor:
+                cursor.execute("SELECT 1")
+        except Exception as e:
+            logger.debug(f"Heartbeat failed for session {session_id}: {str(e)}")
+        _schedule_heartbeat(session_id)
+
+    timer = threading.Timer(HEARTBEAT_INTERVAL, _beat)
+    timer.daemon = True
+    timer.start()
+    _session_heartbeats[session_id] = timer
+
+@lru_cache(maxsize=1)
 def get_snowflake_credentials() -> Dict[str, str]:
-    """Load Snowflake credentials from environment variables."""
+    """Load Snowflake credentials from environment variables.
+
+    Env vars are stable for the process lifetime, so the dict is built
+    once and reused; callers that add keys must copy first.
+    """
     user = os.environ.get("SNOWFLAKE_USER")
     password = os.environ.get("SNOWFLAKE_PASSWORD")
     account = os.environ.get("SNOWFLAKE_ACCOUNT")
@@ -37,30 +109,146 @@ def get_snowflake_credentials() -> Dict[str, str]:
         "warehouse": os.environ.get("SNOWFLAKE_WAREHOUSE", "COMPUTE_WH_PARTICIPANT"),
     }
 
+def close_session(session_id: str = "default"):
+    """Close session connection."""
+    timer = _session_heartbeats.pop(session_id, None)
+    if timer is not None:
+        timer.cancel()
+    if session_id in _session_connections:
+        try:
+            _session_connections[session_id][0].close()
+        except:
+            pass
+        del _session_connections[session_id]
+
+def get_or_create_connection(session_id: str, database: str = None) -> Any:
+    """Get existing connection or create new one for session.
+
+    Reusing one authenticated connection per session skips the TLS +
+    login handshake (seconds of latency) that a fresh connect() pays on
+    every query.
+    """
+    if session_id in _session_connections:
+        conn, current_database = _session_connections[session_id]
+        if not conn.is_closed():
+            # Only pay the USE DATABASE round-trip when the session is
+            # actually switching databases
+            if database and database != current_database:
+                try:
+                    with conn.cursor() as cursor:
+                        cursor.execute(f"USE DATABASE {database}")
+                    _session_connections[session_id] = (conn, database)
+                except Exception as e:
+                    logger.warning(f"Could not switch database to {database} for existing session {session_id}: {str(e)}")
+            return conn
+
+    creds = get_snowflake_credentials()
+    if database:
+        creds = {**creds, 'database': database}
+
+    # keep_alive stops the server from expiring an idle pooled session.
+    # Arrow result format halves decode cost versus JSON rows (and feeds
+    # fetch_arrow_all zero-copy); cached results let repeated exploratory
+    # queries skip compute entirely.
+    conn = snowflake.connector.connect(
+        client_session_keep_alive=True,
+        session_parameters={
+            'QUERY_RESULT_FORMAT': 'ARROW',
+            'USE_CACHED_RESULT': 'TRUE',
+            'CLIENT_RESULT_CHUNK_SIZE': 100,
+        },
+        **creds,
+    )
+    _session_connections[session_id] = (conn, database)
+    _schedule_heartbeat(session_id)
+    return conn
+
+def _format_sql_result(cursor: Any, preview: bool = False) -> str:
+    """
+    Format a cursor's result set as (possibly truncated) CSV text.
+    preview marks a LIMIT-rewritten query, whose rowcount reflects the
+    preview cap rather than the true result size.
+
+    Rows are streamed in batches and serialization stops once the
+    display budget (MAX_CSV_CHARS) is filled, so a large result never
+    has to be materialized in full — the old fetchall() + DataFrame
+    path held two copies of the whole result set in memory. Rows are
+    written straight from the cursor tuples with csv.writer; building a
+    DataFrame per batch only to call to_csv would cost dtype inference
+    and an extra copy for nothing.
+    """
+    if not cursor.description:
+        return None  # No result set (DDL/DML); caller commits
+
+    headers = [desc[0] for desc in cursor.description]
+    total_rows = cursor.rowcount
+
+    buf = io.StringIO()
+    writer = csv.writer(buf, lineterminator='\n')
+    writer.writerow(headers)
+    while buf.tell() <= MAX_CSV_CHARS:
+        rows = cursor.fetchmany(1024)
+        if not rows:
+            break
+        writer.writerows(rows)
+
+    if not total_rows:
+        return "Query executed successfully, but no rows returned."
+
+    if buf.tell() > MAX_CSV_CHARS:
+        # Copy out only the displayed prefix; getvalue() followed by a
+        # slice would duplicate the whole over-budget buffer first
+        buf.seek(0)
+        truncated_csv = buf.read(MAX_CSV_CHARS)
+
+        # Find the last complete line to avoid cutting in the middle
+        last_newline = truncated_csv.rfind('\n')
+        if last_newline > 0:
+            truncated_csv = truncated_csv[:last_newline]
+
+        if preview:
+            note = _TRUNC_NOTE_PREVIEW.format(max_chars=MAX_CSV_CHARS, rows=PREVIEW_ROWS)
+        else:
+            note = _TRUNC_NOTE.format(max_chars=MAX_CSV_CHARS, rows=total_rows)
+        return ''.join((_OK_HEADER, truncated_csv, _OK_FOOTER, note))
+
+    parts = [_OK_HEADER, buf.getvalue(), _OK_FOOTER]
+    if preview and total_rows == PREVIEW_ROWS:
+        # The preview is exactly full, so the true result may be larger
+        parts.append(_PREVIEW_NOTE.format(rows=PREVIEW_ROWS))
+    return ''.join(parts)
+
+def _limit_for_display(sql: str) -> str:
+    """
+    Wrap a plain exploratory SELECT in an outer LIMIT so only a preview's
+    worth of rows is transferred. Queries that already bound or shape
+    their output (LIMIT/INTO/GROUP BY/ORDER BY) are left untouched, as
+    are non-SELECT statements.
+    """
+    body = sql.rstrip('; \t\r\n')
+    if _SELECT_RE.match(body) and not _NO_LIMIT_REWRITE_RE.search(body):
+        # Newline before the closing paren: the body may end in a
+        # line comment that would otherwise swallow ") LIMIT ..."
+        return f"SELECT * FROM ({body}\n) LIMIT {PREVIEW_ROWS}"
+    return sql
+
 def execute_snowflake_sql(sql: str, **kwargs) -> Dict[str, Any]:
     logger.info(f"Executing Snowflake SQL: {sql}")
-    
+
     timeout = kwargs.get('timeout', TIMEOUT)
     database = kwargs.get('database', None)  # Optional database context
+    session_id = kwargs.get('session_id', 'default')
+    previewed = False
+    if not kwargs.get('no_limit', False):
+        rewritten = _limit_for_display(sql)
+        previewed = rewritten is not sql
+        sql = rewritten
     start_time = time.time()
-    
+
     content = ""
-    
-    conn = None
+
     try:
-        # Get Snowflake credentials from file
-        snowflake_credential = get_snowflake_credentials()
-        
-        # Add database to connection if specified
-        if database:
-            snowflake_credential = {**snowflake_credential, 'database': database}
-        
-        # Connect to Snowflake using credentials
-        conn = snowflake.connector.connect(
-            **snowflake_credential,
-            login_timeout=timeout,
-            network_timeout=timeout
-        )
+        conn = get_or_create_connection(session_id, database)
         cursor = conn.cursor()
         
         # Execute SQL query
@@ -68,48 +256,14 @@ def execute_snowflake_sql(sql: str, **kwargs) -> Dict[str, Any]:
         
         # First print success message
         print("Query executed successfully")
-        
+
         # Fetch results if the query returns data
-        if cursor.description:
-            headers = [desc[0] for desc in cursor.description]
-            rows = cursor.fetchall()
-            if rows:
-                df = pd.DataFrame(rows, columns=headers)
-                
-                # Convert full dataset to CSV
-                full_csv_data = df.to_csv(index=False)
-                total_rows = len(df)
-                
-                # Check if we need to truncate by character length
-                if len(full_csv_data) > MAX_CSV_CHARS:
-                    # Truncate to MAX_CSV_CHARS characters
-                    truncated_csv = full_csv_data[:MAX_CSV_CHARS]
-                    
-                    # Find the last complete line to avoid cutting in the middle
-                    last_newline = truncated_csv.rfind('\n')
-                    if last_newline > 0:
-                        truncated_csv = truncated_csv[:last_newline]
-                    
-                    content = f"""Query executed successfully
-
-```csv
-{truncated_csv}
-```
-
-Note: The result has been truncated to {MAX_CSV_CHARS} characters for display purposes. The complete result set contains {total_rows} rows and {len(full_csv_data)} characters."""
-                else:
-                    content = f"""Query executed successfully
-
-```csv
-{full_csv_data}
-```"""
-            else:
-                content = "Query executed successfully, but no rows returned."
-        else:
+        content = _format_sql_result(cursor, preview=previewed)
+        if content is None:
             conn.commit()
             content = "Query executed successfully."
-        
-        
+
+
     except ProgrammingError as e:
         content = f"SQL Error: {str(e)}"
         logger.error(f"Snowflake SQL error: {str(e)}")
@@ -123,10 +277,8 @@ Note: The result has been truncated to {MAX_CSV_CHARS} characters for display pu
         content = f"Unexpected error: {str(e)}"
         logger.error(f"Unexpected error executing Snowflake query: {str(e)}")
     finally:
-        if conn:
-            conn.close()
-            
-        # Log execution time
+        # Connection stays pooled for the session; a dead one is detected
+        # and replaced on the next call
         execution_time = time.time() - start_time
         logger.info(f"Execution completed in {execution_time:.2f} seconds")
     
@@ -134,6 +286,55 @@ Note: The result has been truncated to {MAX_CSV_CHARS} characters for display pu
         "content": f"EXECUTION RESULT of [execute_snowflake_sql]:\n{content}"
     }
 
+def execute_snowflake_sql_arrow(sql: str, **kwargs) -> Dict[str, Any]:
+    """
+    Execute SQL and return the result as LZ4-compressed Arrow IPC bytes
+    (base64-encoded in "content_ipc").
+
+    For consumers that can read Arrow this skips CSV encoding entirely:
+    the payload is several times smaller and far cheaper to produce than
+    pandas to_csv. execute_snowflake_sql remains the text/CSV fallback.
+    """
+    logger.info(f"Executing Snowflake SQL (arrow): {sql}")
+
+    database = kwargs.get('database', None)
+    session_id = kwargs.get('session_id', 'default')
+
+    try:
+        import base64
+        import pyarrow as pa
+
+        conn = get_or_create_connection(session_id, database)
+        cursor = conn.cursor()
+        cursor.execute(sql)
+
+        if not cursor.description:
+            conn.commit()
+            return {"content": "Query executed successfully."}
+
+        table = cursor.fetch_arrow_all()
+        if table is None or table.num_rows == 0:
+            return {"content": "Query executed successfully, but no rows returned."}
+
+        sink = io.BytesIO()
+        options = pa.ipc.IpcWriteOptions(compression="lz4")
+        with pa.ipc.new_stream(sink, table.schema, options=options) as writer:
+            writer.write_table(table)
+
+        return {
+            "content_ipc": base64.b64encode(sink.getvalue()).decode("ascii"),
+            "rows": table.num_rows,
+        }
+    except ProgrammingError as e:
+        logger.error(f"Snowflake SQL error: {str(e)}")
+        return {"content": f"SQL Error: {str(e)}"}
+    except DatabaseError as e:
+        logger.error(f"Snowflake database error: {str(e)}")
+        return {"content": f"Database error: {str(e)}"}
+    except Exception as e:
+        logger.error(f"Unexpected error executing Snowflake query: {str(e)}")
+        return {"content": f"Unexpected error: {str(e)}"}
+
 def execute_snowflake_sql_batch(queries: list, **kwargs) -> list:
     """
     Execute multiple SQL queries in a single connection.
@@ -156,52 +357,61 @@ def execute_snowflake_sql_batch(queries: list, **kwargs) -> list:
     conn = None
     
     try:
-        snowflake_credential = get_snowflake_credentials()
+        # One copy of the cached credentials, then in-place assignment
+        creds = dict(get_snowflake_credentials())
         if database:
-            snowflake_credential = {**snowflake_credential, 'database': database}
+            creds['database'] = database
             # Default schema to database name if not specified (common pattern)
             if not schema:
                 schema = database
         if schema:
-            snowflake_credential = {**snowflake_credential, 'schema': schema}
-        
+            creds['schema'] = schema
+
         conn = snowflake.connector.connect(
-            **snowflake_credential,
+            **creds,
             login_timeout=timeout,
             network_timeout=timeout
         )
         cursor = conn.cursor()
-        
+
+        # Submit phase: each statement is submitted asynchronously and only
+        # awaited for *completion*, not fetched — result download no longer
+        # sits between dependent statements, so they run back-to-back
+        # server-side. A statement is only submitted after the previous one
+        # finished, preserving temp-table ordering and stop-on-error
+        # semantics.
+        completed_qids = []
+        submit_error = None
         for sql in queries:
             try:
-                cursor.execute(sql)
-                
-                if cursor.description:
-                    headers = [desc[0] for desc in cursor.description]
-                    rows = cursor.fetchall()
-                    if rows:
-                        df = pd.DataFrame(rows, columns=headers)
-                        csv_data = df.to_csv(index=False)
-                        if len(csv_data) > MAX_CSV_CHARS:
-                            truncated = csv_data[:MAX_CSV_CHARS]
-                            last_nl = truncated.rfind('\n')
-                            if last_nl > 0:
-                                truncated = truncated[:last_nl]
-                            content = f"Query executed successfully\n\n```csv\n{truncated}\n```\n\nNote: Truncated to {MAX_CSV_CHARS} chars. Total: {len(rows)} rows."
-                        else:
-                            content = f"Query executed successfully\n\n```csv\n{csv_data}```"
-                    else:
-                        content = "Query executed successfully, but no rows returned."
-                else:
+                cursor.execute_async(sql)
+                sfqid = cursor.sfqid
+                while conn.is_still_running(conn.get_query_status_throw_if_error(sfqid)):
+                    time.sleep(0.1)
+                completed_qids.append(sfqid)
+            except (ProgrammingError, DatabaseError) as e:
+                submit_error = f"SQL Error: {str(e)}"
+                break  # Stop on error
+
+        # Fetch phase: pull results of the completed statements in order
+        for sfqid in completed_qids:
+            try:
+                cursor.get_results_from_sfqid(sfqid)
+
+                content = _format_sql_result(cursor)
+                if content is None:
                     conn.commit()
                     content = "Query executed successfully."
-                
+
                 results.append({"content": f"EXECUTION RESULT of [execute_snowflake_sql]:\n{content}", "success": True})
-                
+
             except (ProgrammingError, DatabaseError) as e:
                 results.append({"content": f"EXECUTION RESULT of [execute_snowflake_sql]:\nSQL Error: {str(e)}", "success": False})
                 break  # Stop on error
-                
+
+        if submit_error:
+            results.append({"content": f"EXECUTION RESULT of [execute_snowflake_sql]:\n{submit_error}", "success": False})
+
     except Exception as e:
         results.append({"content": f"EXECUTION RESULT of [execute_snowflake_sql]:\nConnection error: {str(e)}", "success": False})
     finally:
@@ -212,4 +422,6 @@ def execute_snowflake_sql_batch(queries: list, **kwargs) -> list:
 
 
 def register_tools(registry):
-    registry.register_tool("execute_snowflake_sql", execute_snowflake_sql)
\ No newline at end of file
+    registry.register_tool("execute_snowflake_sql", execute_snowflake_sql)
+    registry.register_tool("execute_snowflake_sql_arrow", execute_snowflake_sql_arrow)
+    registry.register_tool("close_session", close_session)
\ No newline at end of file
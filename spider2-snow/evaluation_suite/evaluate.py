@@ -173,9 +173,9 @@ def get_snowflake_sql_result(sql_query, database_id, is_save, save_dir=None, fil
 
     try:
         cursor.execute(sql_query)
-        results = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(results, columns=columns)
+        # Arrow path: columns arrive with their dtypes declared, skipping
+        # the row-tuple materialization and pandas' object-inference scan
+        df = cursor.fetch_pandas_all()
         if df.empty:
             message = "No data found for the specified query."
             print(f"{prefix}{message}")
@@ -195,9 +195,9 @@ def get_snowflake_sql_result_sequence(sql_queries, database_id, is_save, save_di
             if i == len(sql_queries) - 1:
                 # The last query is the one we want the result for
                 if cursor.description:
-                    results = cursor.fetchall()
-                    columns = [desc[0] for desc in cursor.description]
-                    df = pd.DataFrame(results, columns=columns)
+                    # Arrow path: dtypes come declared from the server,
+                    # skipping pandas' object-inference scan over row tuples
+                    df = cursor.fetch_pandas_all()
                 else:
                     message = "Last query produced no results (not a SELECT)."
                     print(f"{prefix}{message}")
@@ -145,12 +145,12 @@ def get_snowflake_sql_result(sql_query, is_save, save_dir=None, file_name="resul
     cursor = conn.cursor()
     try:
         cursor.execute(sql_query)
-        results = cursor.fetchall()
-        columns = [desc[0] for desc in cursor.description]
-        df = pd.DataFrame(results, columns=columns)
+        # Arrow path: columns arrive with their dtypes declared, skipping
+        # the row-tuple materialization and pandas' object-inference scan
+        df = cursor.fetch_pandas_all()
         if df.empty:
             print("No data found for the specified query.")
-            results.to_csv(os.path.join(save_dir, file_name), index=False)
+            df.to_csv(os.path.join(save_dir, file_name), index=False)
             return None, None
         else:
             if is_save:
@@ -48,6 +48,11 @@ def parse_args() -> argparse.Namespace:
         default="",
         help="Comma-separated list of columns to read (optional).",
     )
+    p.add_argument(
+        "--pandas",
+        action="store_true",
+        help="Pretty-print via pandas (copies the sample into a DataFrame).",
+    )
     return p.parse_args()
 
 
@@ -56,7 +61,9 @@ def main() -> int:
     target = (repo_root() / args.path).resolve() if not args.path.is_absolute() else args.path
 
     try:
+        import pyarrow as pa
         import pyarrow.dataset as ds
+        import pyarrow.parquet as pq
     except Exception as e:  # pragma: no cover
         print(
             "Missing dependency: pyarrow.\n"
@@ -73,25 +80,42 @@ def main() -> int:
 
     columns = [c.strip() for c in args.columns.split(",") if c.strip()] or None
 
-    dataset = ds.dataset(str(target), format="parquet")
+    if target.is_file():
+        # Single parquet file: read the first row batch directly, skipping
+        # the dataset-discovery and scan-planning machinery entirely.
+        pf = pq.ParquetFile(str(target))
+        schema = pf.schema_arrow
+        batch = next(pf.iter_batches(batch_size=args.n, columns=columns), None)
+        if batch is not None:
+            table = pa.Table.from_batches([batch])
+        else:
+            table = schema.empty_table() if columns is None else schema.empty_table().select(columns)
+    else:
+        dataset = ds.dataset(str(target), format="parquet")
+        schema = dataset.schema
+        table = dataset.head(args.n, columns=columns)
+
     print("== Dataset ==")
     print(f"path:   {target}")
-    print(f"schema: {dataset.schema}")
+    print(f"schema: {schema}")
     print()
 
-    table = dataset.head(args.n, columns=columns)
-
-    # Pretty-print via pandas when available.
-    try:
-        import pandas as pd  # noqa: F401
-
-        df = table.to_pandas()
-        print("== Sample rows ==")
-        with __import__("pandas").option_context("display.max_columns", 200, "display.width", 200):
-            print(df)
-    except Exception:
-        print("== Sample rows (pyarrow) ==")
-        print(table.to_string())
+    # Arrow's native repr is the default: to_pandas() would copy every
+    # string column (content blobs are many MB per row) just to print.
+    if args.pandas:
+        try:
+            import pandas as pd  # noqa: F401
+
+            df = table.to_pandas()
+            print("== Sample rows ==")
+            with __import__("pandas").option_context("display.max_columns", 200, "display.width", 200):
+                print(df)
+            return 0
+        except Exception:
+            pass
+
+    print("== Sample rows (pyarrow) ==")
+    print(table.to_string(preview_cols=10))
 
     return 0
 